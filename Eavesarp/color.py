@@ -2,6 +2,16 @@
 
 import colored
 from emoji import emojize
+from functools import lru_cache
+
+@lru_cache(maxsize=1024,typed=True)
+def stylize_cached(value,style):
+    '''Apply a style to a value. Results are cached since the same
+    values (sender IPs, booleans, etc.) recur across table rows and
+    redraws.
+    '''
+
+    return colored.stylize(value,style)
 
 class ColorProfile:
 
@@ -28,7 +38,7 @@ class ColorProfile:
         return self.style_list(values,self.odd_style)
 
     def style_list(self, values, style):
-        return [colored.stylize(v,style) for v in values]
+        return [stylize_cached(v,style) for v in values]
 
 ColorProfiles = {
     'disable':None,
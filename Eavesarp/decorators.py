@@ -37,16 +37,3 @@ def validate_packet_unpack(func):
         
 
     return wrapper
-
-
-def unpack_packets(func):
-    '''Unpack a list of packets to src/dst addresses.
-    '''
-    
-    def wrapper(packets, *args, **kwargs):
-
-        packets = [unpack_packet(packet) for packet in packets]
-
-        return func(packets, *args, **kwargs)
-
-    return wrapper
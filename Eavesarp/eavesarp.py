@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import signal
-import re
+import socket
+import dpkt
 from Eavesarp.sql import *
 from Eavesarp.lists import Lists
 from Eavesarp.decorators import *
@@ -10,17 +11,26 @@ from Eavesarp.resolve import *
 from Eavesarp.misc import *
 from Eavesarp.output import *
 from Eavesarp.logo import *
-from scapy.all import sniff,ARP,wrpcap,rdpcap,sr
+from scapy.config import conf
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap
+from queue import Queue,Full,Empty
+from select import select
+from threading import Thread,Event
 from time import sleep
 from multiprocessing.pool import Pool
+from collections import Counter
 from sys import stdout
 
 
 @validate_packet_unpack
 def filter_packet(packet,sender_lists=None,target_lists=None):
-    '''Filter an individual packet. This should be executed in the `lambda`
-    supplied to `do_sniff`. `sender_lists` and `target_lists` should be
-    objects of type `List()`.
+    '''Filter an individual packet. This is executed by the calling
+    thread of `do_sniff` after each frame is dissected. `sender_lists`
+    and `target_lists` should be objects of type `List()`.
+
+    Returns the unpacked `(sender,sender_mac,target)` tuple when the
+    packet passes the filter, otherwise `False`.
     '''
 
     if not packet: return False
@@ -35,11 +45,22 @@ def filter_packet(packet,sender_lists=None,target_lists=None):
 
     return packet
 
-@unpack_packets
-def handle_packets(packets,db_session):
-    '''Handle packets capture from the interface.
+def handle_unpacked_packets(packets,db_session):
+    '''Handle `(sender,sender_mac,target)` tuples. All packets are
+    written in a single transaction, which is committed once the
+    final packet has been handled.
+
+    IP and Transaction objects are cached on the session so that
+    recurring addresses do not require additional queries.
     '''
 
+    if not hasattr(db_session,'_ip_cache'):
+        db_session._ip_cache = {}
+        db_session._tx_cache = {}
+
+    ip_cache = db_session._ip_cache
+    tx_cache = db_session._tx_cache
+
     for packet in packets:
 
         sender,shw,target = packet
@@ -47,41 +68,112 @@ def handle_packets(packets,db_session):
         # GET/CREATE database objects
         sender = get_or_create_ip(sender,
                 db_session,
-                mac_address=shw)
+                mac_address=shw,
+                ip_cache=ip_cache)
 
         target = get_or_create_ip(target,
-                db_session)
+                db_session,
+                ip_cache=ip_cache)
 
         # Determine if a transaction record for the
           # target/sender pair exists
             # if not, create it
             # else, get and increment it
-        transaction = db_session.query(Transaction) \
-            .filter(
-                Transaction.sender_ip_id==sender.id,
-                Transaction.target_ip_id==target.id
-            ).first()
+        key = (sender.id,target.id,)
+        transaction = tx_cache.get(key)
+
+        if not transaction:
+
+            transaction = get_transaction(sender.id,target.id,
+                    db_session)
 
         if not transaction:
 
             transaction = Transaction(sender_ip_id=sender.id,
-                    target_ip_id=target.id)
+                    target_ip_id=target.id, count=1)
             db_session.add(transaction)
 
         else:
 
             transaction.count += 1
 
-        db_session.commit()
+        tx_cache[key] = transaction
+
+    db_session.commit()
 
-def do_sniff(interfaces,redraw_frequency,sender_lists,target_lists):
+def do_sniff(interfaces,redraw_frequency,sender_lists,target_lists,
+        queue_size=1000):
     '''Start the sniffer while filtering for WHO-HAS broadcast requests.
+
+    Raw frames are read from a layer 2 listen socket by a receiver
+    thread and handed to the calling thread through a bounded queue.
+    Dissection and `filter_packet` are performed by the calling
+    thread, keeping them off of the receive path. Sniffing stops once
+    `redraw_frequency` packets have passed the filter. Exceptions
+    raised by the receiver are raised again by the calling thread.
+
+    Returns a tuple of `(packets,unpacked)`, where `packets` is the list
+    of accepted Scapy packets and `unpacked` holds the corresponding
+    `(sender,sender_mac,target)` tuples extracted by `filter_packet`.
     '''
 
-    return sniff(iface=interfaces,
-        lfilter=lambda pkt: filter_packet(pkt,sender_lists,target_lists),
-        count=redraw_frequency
-    )
+    sock = conf.L2listen(iface=interfaces)
+
+    pqueue = Queue(maxsize=queue_size)
+    packets = []
+    unpacked = []
+    errors = []
+    done = Event()
+
+    def receive():
+
+        try:
+
+            while not done.is_set():
+
+                # Wait for a frame without blocking past `done`
+                if not select([sock],[],[],1)[0]: continue
+
+                cls, raw, ts = sock.recv_raw()
+                if raw is None: continue
+
+                try:
+                    pqueue.put((cls,raw,ts,),timeout=1)
+                except Full:
+                    pass
+
+        except Exception as e:
+
+            errors.append(e)
+
+    receiver = Thread(target=receive,daemon=True)
+    receiver.start()
+
+    try:
+
+        while packets.__len__() < redraw_frequency:
+
+            try:
+                cls, raw, ts = pqueue.get(timeout=1)
+            except Empty:
+                if errors: raise errors[0]
+                continue
+
+            pkt = (cls or Ether)(raw)
+            if ts is not None: pkt.time = ts
+
+            values = filter_packet(pkt,sender_lists,target_lists)
+            if values:
+                packets.append(pkt)
+                unpacked.append(values)
+
+    finally:
+
+        done.set()
+        receiver.join()
+        sock.close()
+
+    return packets,unpacked
 
 def async_sniff(interface, redraw_frequency, sender_lists,
         target_lists, dbfile):
@@ -91,20 +183,68 @@ def async_sniff(interface, redraw_frequency, sender_lists,
     forever or until an inordinate number of keyboard interrupts occur.
     '''
 
-    sess = create_db(dbfile)
+    sess = create_db(dbfile,wal=True)
 
     # Capture packets
-    packets = do_sniff(interface,
+    packets, unpacked = do_sniff(interface,
             redraw_frequency, sender_lists,
             target_lists)
 
-    # Handle packets (to the db they go, yo)
-    handle_packets(packets, sess)
+    # Handle packets (to the db they go, yo). The ARP layer has
+    # already been unpacked by `filter_packet`.
+    handle_unpacked_packets(unpacked, sess)
 
     sess.close()
 
     return packets
 
+# Link layer decoders for each supported pcap datalink type
+LINK_DECODERS = {
+    dpkt.pcap.DLT_EN10MB:dpkt.ethernet.Ethernet,
+    dpkt.pcap.DLT_LINUX_SLL:dpkt.sll.SLL,
+}
+
+def read_pcap_requests(pfile):
+    '''Stream ARP WHO-HAS requests from a pcap file, yielding a
+    `(sender,sender_mac,target)` tuple for each. Packets are parsed
+    with dpkt to avoid materializing Scapy objects.
+
+    Ethernet and Linux cooked (SLL) captures are supported. Files
+    with any other link type are skipped with a warning.
+    '''
+
+    with open(pfile,'rb') as infile:
+
+        try:
+            reader = dpkt.pcap.Reader(infile)
+        except ValueError:
+            infile.seek(0)
+            reader = dpkt.pcapng.Reader(infile)
+
+        decoder = LINK_DECODERS.get(reader.datalink())
+        if not decoder:
+            print(f'- Unsupported link type ({reader.datalink()}), ' \
+                f'skipping: {pfile}')
+            return
+
+        for ts, buf in reader:
+
+            try:
+                frame = decoder(buf)
+            except dpkt.dpkt.UnpackError:
+                continue
+
+            arp = frame.data
+            if not isinstance(arp,dpkt.arp.ARP) or \
+                    arp.op != dpkt.arp.ARP_OP_REQUEST:
+                continue
+
+            yield (
+                socket.inet_ntoa(arp.spa),
+                ':'.join(f'{b:02x}' for b in arp.sha),
+                socket.inet_ntoa(arp.tpa),
+            )
+
 def analyze(database_output_file, sender_lists=None, target_lists=None,
         analysis_output_file=None, pcap_files=[], sqlite_files=[],
         color_profile=None, dns_resolve=True, csv_output_file=None,
@@ -114,7 +254,7 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
     each type of input file.
     '''
 
-    outdb_sess = create_db(database_output_file,overwrite=True)
+    outdb_sess = create_db(database_output_file,overwrite=True,wal=True)
 
     # ===================
     # HANDLE SQLITE FILES
@@ -124,7 +264,17 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
     Import the source database to the new database by reading in
     each transaction. Note that new id values are assigned to
     each IP in the process.
+
+    Transaction counts and PTR records are accumulated in memory
+    and written to the new database in bulk after all files have
+    been read.
     '''
+
+    ip_cache = {}
+    counter = Counter()
+    ptr_map = {}
+    ptr_values = set()
+
     for sfile in sqlite_files:
 
         isess = create_db(sfile)
@@ -133,7 +283,7 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
         # ITERATE OVER EACH TRANSACTION AND TRANSFER TO NEW DB
         # ====================================================
 
-        for t in isess.query(Transaction).all():
+        for t in get_transactions(isess):
 
             ips = []
             for handle in ['sender','target']:
@@ -143,6 +293,7 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
                 # Create a dictionary of arguments to create the IP
                 kwargs = {
                     'db_session':outdb_sess,
+                    'ip_cache':ip_cache,
                 }
                 for attr in ['value','arp_resolve_attempted',
                     'reverse_dns_attempted', 'mac_address']:
@@ -153,10 +304,15 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
 
                 # Associate the ptr
                 ptr = tip.ptr[0].value if tip.ptr else None
-                if ptr:
+                if ptr and ip.id not in ptr_map and \
+                        ptr not in ptr_values:
 
-                    get_or_create_ptr(ptr,ip.id,outdb_sess,
-                            tip.ptr[0].forward_ip)
+                    ptr_values.add(ptr)
+                    ptr_map[ip.id] = {
+                        'ip_id':ip.id,
+                        'value':ptr,
+                        'forward_ip':tip.ptr[0].forward_ip
+                    }
 
                 # Append the ip
                 ips.append(ip)
@@ -164,48 +320,49 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
             # Expand list into sender/target value
             sender, target = ips
 
-            # ======================
-            # HANDLE THE TRANSACTION
-            # ======================
+            # Accumulate the transaction count
+            counter[(sender.id,target.id,)] += t.count
 
-            transaction = outdb_sess.query(Transaction).filter(
-                Transaction.sender_ip_id==sender.id,
-                Transaction.target_ip_id==target.id).first()
+        isess.close()
 
-            if transaction:
+    # ==================================
+    # BULK INSERT TRANSACTIONS AND PTRS
+    # ==================================
 
-                transaction.count += t.count
+    if counter:
 
-            else:
+        outdb_sess.execute(
+            Transaction.__table__.insert(),
+            [
+                {'sender_ip_id':sid,'target_ip_id':tid,'count':count}
+                for (sid,tid),count in counter.items()
+            ]
+        )
 
-                outdb_sess.add(
-                    Transaction(
-                        sender_ip_id=sender.id,
-                        target_ip_id=target.id,
-                        count=t.count,
-                    )
-                )
+    if ptr_map:
+
+        outdb_sess.execute(
+            PTR.__table__.insert(),
+            list(ptr_map.values())
+        )
 
-            outdb_sess.commit()
+    outdb_sess.commit()
 
     # =====================
     # HANDLE EACH PCAP FILE
     # =====================
 
     '''
-    This is much easier than SQLITE files since we can just use
-    Scapy to slurp the packets from each target file, filter each
-    packet, and then use `handle_packets` to populate the database.
+    This is much easier than SQLITE files since we can just stream
+    the ARP WHO-HAS requests from each target file and then use
+    `handle_unpacked_packets` to populate the database.
     '''
 
     for pfile in pcap_files:
 
-        # Assure that each packet is ARP WHO-HAS
-        packets = [p for p in rdpcap(pfile) if filter_packet(p)]
-
         # Insert the records
-        handle_packets(
-            packets,
+        handle_unpacked_packets(
+            read_pcap_requests(pfile),
             outdb_sess
         )
 
@@ -230,7 +387,7 @@ def analyze(database_output_file, sender_lists=None, target_lists=None,
                 ).read()
             )
 
-    outdb_sess.close()
+    close_db(outdb_sess)
 
 def capture(interface,database_output_file,redraw_frequency,arp_resolve,
         dns_resolve,sender_lists,target_lists,color_profile,
@@ -243,6 +400,8 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
     pool = Pool(3)
     signal.signal(signal.SIGINT, osigint)
 
+    sess = None
+
     try:
 
         # ==============
@@ -250,10 +409,11 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
         # ==============
 
         '''
-        The sniffer is started in a distinct process because Scapy
-        will block forever when scapy.all.sniff is called. This allows
-        us to interrupt execution of the sniffer by terminating the
-        process.
+        The sniffer is started in a distinct process because
+        `do_sniff` blocks until `redraw_frequency` packets have passed
+        the filter, which may never happen on a quiet network. This
+        allows us to interrupt execution of the sniffer by terminating
+        the process.
 
         TODO: It may be easier to use threading. Pool methods were fresh
         to me at the time of original development.
@@ -273,7 +433,7 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
         print(f'Capture interface: {interface}')
         print(f'ARP resolution:    {arp_resolution}')
         print(f'DNS resolution:    {dns_resolution}')
-        sess = create_db(dbfile)
+        sess = create_db(dbfile,wal=True)
 
         # ======================================
         # CREATE AN IP FOR THE CURRENT INTERFACE
@@ -285,6 +445,7 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
             ip = get_or_create_ip(ip,
                 sess,
                 mac_address=iface_mac)
+        sess.commit()
 
         if not Path(dbfile).exists():
             print('- Initializing capture\n- This may take time depending '\
@@ -405,7 +566,6 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
     except KeyboardInterrupt:
 
         print('\n- CTRL^C Caught...')
-        sess.close()
 
     finally:
 
@@ -444,3 +604,7 @@ def capture(interface,database_output_file,redraw_frequency,arp_resolve,
 
         pool.join()
 
+        # Fold the write-ahead log into the database file now that
+        # the child processes have stopped writing
+        if sess is not None: close_db(sess)
+
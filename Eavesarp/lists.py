@@ -14,14 +14,40 @@ class Lists:
 
         return f'<Lists white:{self.white}, black:{self.black}>'
 
+    @property
+    def white(self):
+        return self._white
+
+    @white.setter
+    def white(self,value):
+        '''Set the whitelist and a set of its values used by `check`.
+        Lists modified in place must be reassigned to update the set.
+        '''
+
+        self._white = value
+        self._white_set = frozenset(value)
+
+    @property
+    def black(self):
+        return self._black
+
+    @black.setter
+    def black(self,value):
+        '''Set the blacklist and a set of its values used by `check`.
+        Lists modified in place must be reassigned to update the set.
+        '''
+
+        self._black = value
+        self._black_set = frozenset(value)
+
     def check(self,ip):
         '''Check an IP against a Lists object to determine if it
         should be included in output.
         '''
     
-        if self.black and ip in self.black:
+        if ip in self._black_set:
             return False
-        elif self.white and ip not in self.white:
+        elif self._white_set and ip not in self._white_set:
             return False
         else:
             return True
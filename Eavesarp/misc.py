@@ -5,15 +5,16 @@ import netifaces
 def unpack_arp(arp):
     '''Validate a packet while returning the target and sender
     in a tuple: `(target,sender)`
-    '''
-
-    return arp.psrc,arp.hwsrc,arp.pdst
 
-def unpack_packet(packet):
-    '''Extract and return the ARP layer from a packet object.
+    Values are read from the `fields` dictionary of the dissected
+    layer, bypassing Scapy's `__getattr__` field resolution.
     '''
 
-    return unpack_arp(packet.getlayer('ARP'))
+    try:
+        fields = arp.fields
+        return fields['psrc'],fields['hwsrc'],fields['pdst']
+    except KeyError:
+        return arp.psrc,arp.hwsrc,arp.pdst
 
 def get_interfaces(require_ip=False):
     interfaces = {}
@@ -6,6 +6,8 @@ from Eavesarp.misc import get_interfaces
 from tabulate import tabulate
 from io import StringIO
 import csv
+import re
+from itertools import cycle
 
 # ===================
 # CONSTANTS/FUNCTIONS
@@ -33,6 +35,51 @@ COL_ORDER = [
     'stale'
 ]
 
+# Regexp to match ANSI escape sequences applied by color profiles
+ansi_re = re.compile(r'\x1b\[[0-9;]*m')
+
+def format_table(rows,headers):
+    '''Format rows as a plain text table resembling the "simple"
+    format of `tabulate`. Widths are calculated from values with ANSI
+    escape sequences removed, and columns holding only digits are
+    right aligned.
+    '''
+
+    headers = [str(h) for h in headers]
+    rows = [['' if v is None else str(v) for v in r] for r in rows]
+
+    # Display length of each cell
+    hlens = [len(ansi_re.sub('',h)) for h in headers]
+    lens = [[len(ansi_re.sub('',v)) for v in r] for r in rows]
+
+    widths, right = [], []
+    for ind,hlen in enumerate(hlens):
+
+        values = [ansi_re.sub('',r[ind]) for r in rows if r[ind]]
+        widths.append(
+            max([hlen+2]+[l[ind] for l in lens])
+        )
+        right.append(
+            bool(values) and all(v.isdigit() for v in values)
+        )
+
+    def format_row(values,vlens):
+
+        cells = []
+        for value,vlen,width,rjust in zip(values,vlens,widths,right):
+            pad = ' '*(width-vlen)
+            cells.append(pad+value if rjust else value+pad)
+
+        return '  '.join(cells).rstrip()
+
+    lines = [
+        format_row(headers,hlens),
+        '  '.join('-'*w for w in widths)
+    ]
+    lines.extend(format_row(r,l) for r,l in zip(rows,lens))
+
+    return '\n'.join(lines)
+
 def validate_columns(output_columns):
 
     vals = COL_MAP.keys()
@@ -120,11 +167,11 @@ def get_stale_ips(db_session):
 
     return snacs
 
-def build_snac(target,stale_ips,color_profile,display_false=True):
-    '''Build the SNAC value for a given sender.
+def format_snac(snac,color_profile,display_false=True):
+    '''Format a boolean SNAC value for output.
     '''
 
-    snac = (False,True)[target in stale_ips]
+    snac = (False,True)[snac]
 
     # Handle color profile
     if color_profile and color_profile.snac_emojis:
@@ -144,6 +191,85 @@ def build_snac(target,stale_ips,color_profile,display_false=True):
 
     return snac
 
+def get_cell_builder(col,stale,color_profile,display_false,
+        force_sender):
+    '''Return a function that builds the value of a column for a
+    transaction. Each function accepts the transaction, the sender
+    and target values, and a flag indicating if the sender is new.
+
+    Builders are specialized for `force_sender` and the SNAC values
+    are formatted up front, since neither changes between rows.
+    '''
+
+    if col == 'snac':
+
+        stale_values = set(ip.value for ip in stale)
+        snacs = (format_snac(False,color_profile,display_false),
+                format_snac(True,color_profile,display_false),)
+
+        if force_sender:
+
+            def build(t,sender,target,new_sender):
+                return snacs[target in stale_values]
+
+        else:
+
+            def build(t,sender,target,new_sender):
+                return snacs[target in stale_values] if new_sender else ''
+
+    elif col == 'sender':
+
+        if force_sender:
+
+            def build(t,sender,target,new_sender):
+                return sender
+
+        else:
+
+            def build(t,sender,target,new_sender):
+                return sender if new_sender else ''
+
+    elif col == 'target':
+
+        def build(t,sender,target,new_sender):
+            return target
+
+    elif col == 'stale':
+
+        def build(t,sender,target,new_sender):
+            return t.build_stale(color_profile,
+                display_false=display_false)
+
+    else:
+
+        if col == 'arp_count': col = 'count'
+        method = getattr(Transaction,'build_'+col)
+
+        def build(t,sender,target,new_sender):
+            return method(t,new_sender=new_sender,
+                display_false=display_false,
+                force_sender=force_sender)
+
+    return build
+
+def get_row_builder(columns,stale,color_profile,display_false,
+        force_sender):
+    '''Return a function that builds a table row for a transaction.
+    Cell builders are resolved once so that columns are not dispatched
+    by name for each row.
+    '''
+
+    builders = [
+        get_cell_builder(col,stale,color_profile,display_false,
+            force_sender)
+        for col in columns
+    ]
+
+    def build_row(t,sender,target,new_sender):
+        return [build(t,sender,target,new_sender) for build in builders]
+
+    return build_row
+
 def get_output_table(db_session,order_by=desc,sender_lists=None,
         target_lists=None,color_profile=None,dns_resolve=True,
         arp_resolve=False,columns=COL_ORDER,display_false=False,
@@ -199,6 +325,10 @@ def get_output_table(db_session,order_by=desc,sender_lists=None,
         if not 'mitm_op' in columns:
             columns.append('mitm_op')
 
+    # Select the cell builders for each column once
+    build_row = get_row_builder(columns,stale,color_profile,
+            display_false,force_sender)
+
     # Organize all the records by sender IP
     rowdict = {}
     for t in transactions:
@@ -222,67 +352,26 @@ def get_output_table(db_session,order_by=desc,sender_lists=None,
         if sender not in rowdict: new_sender = True
         else: new_sender = False
 
-        row = []
-
-        for col in columns:
-
-            if col == 'snac':
-
-                if new_sender or force_sender:
-                
-                    row.append(
-                        build_snac(t.target,stale,color_profile,
-                            display_false)
-                    )
-
-                else:
-
-                    row.append('')
-
-            elif col == 'sender':
-
-                if new_sender or force_sender: row.append(sender)
-                else: row.append('')
-
-            elif col == 'target':
-
-                row.append(target)
-
-            elif col == 'stale':
-
-                row.append(t.build_stale(color_profile,
-                    display_false=display_false))
-
-            else:
-
-                if col == 'arp_count': col = 'count'
-
-                row.append(
-                    t.bfh('build_'+col,new_sender=new_sender,
-                        display_false=display_false,
-                        force_sender=force_sender)
-                )
+        row = build_row(t,sender,target,new_sender)
 
         if new_sender: rowdict[sender] = [row]
         else: rowdict[sender].append(row)
 
     # Restructure dictionary into a list of rows
     rows = []
-    counter = 0
 
-    for sender,irows in rowdict.items():
-        counter += 1
+    # Color odd rows slightly darker
+    if color_profile:
 
-        # Color odd rows slightly darker
-        if color_profile:
+        styles = cycle((color_profile.style_odd,color_profile.style_even,))
+        for irows in rowdict.values():
+            rows.extend(map(next(styles),irows))
 
-            if counter % 2:
-                rows += [color_profile.style_odd([v for v in r]) for r in irows]
-            else:
-                rows += [color_profile.style_even(r) for r in irows]
+    # Just add the rows otherwise
+    else:
 
-        # Just add the rows otherwise
-        else: rows += irows
+        for irows in rowdict.values():
+            rows.extend(irows)
 
     headers = [COL_MAP[col] for col in columns]
 
@@ -290,6 +379,4 @@ def get_output_table(db_session,order_by=desc,sender_lists=None,
     if color_profile: headers = color_profile.style_header(headers)
 
     # Return the output as a table
-    return tabulate(
-            rows,
-            headers=headers)
+    return format_table(rows,headers)
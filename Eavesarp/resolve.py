@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 from Eavesarp.sql import *
-from scapy.all import ARP,sr
-from dns import reversename, resolver
+from scapy.layers.l2 import ARP
+from scapy.sendrecv import sr
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def reverse_dns_resolve(ip):
     '''Attempt reverse name resolution on an IP address. Returns
     `None` upon exception, which occurs when an address without a
     PTR record is requested.
     '''
+
+    # Imported here so that dnspython is loaded only when
+    # resolution is performed
+    from dns import reversename, resolver
     
     try:
 
@@ -27,35 +32,62 @@ def reverse_dns_resolve(ip):
 
         return None,None
 
-def reverse_dns_resolve_ips(db_file):
+def reverse_dns_resolve_ips(db_file,max_workers=32):
+    '''Reverse resolve each IP that has not yet been attempted. Lookups
+    are performed concurrently by a pool of `max_workers` threads and
+    the resulting PTR records are written in a single commit.
+    '''
 
-    sess = create_db(db_file)
+    sess = create_db(db_file,wal=True)
     ips = sess.query(IP) \
         .filter(IP.reverse_dns_attempted != True) \
         .all()
 
-    for ip in ips:
-        ptr,forward_ip = reverse_dns_resolve(ip.value)
-        if ptr:
-            sess.add(
-                PTR(ip_id=ip.id,
-                    value=ptr[:ptr.__len__()-1],
-                    forward_ip=forward_ip)
-                )
-        ip.reverse_dns_attempted = True
-        sess.commit()
+    # PTR values are unique, so only the first IP resolving to
+    # a given name receives the record
+    ptrs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        futures = {
+            executor.submit(reverse_dns_resolve,ip.value):ip
+            for ip in ips
+        }
+
+        for future in as_completed(futures):
+
+            ip = futures[future]
+            ptr,forward_ip = future.result()
+            if ptr:
+                value = ptr[:ptr.__len__()-1]
+                if value not in ptrs:
+                    ptrs[value] = PTR(ip_id=ip.id,
+                        value=value,
+                        forward_ip=forward_ip)
+            ip.reverse_dns_attempted = True
+
+    # Skip names already associated with another IP
+    if ptrs:
+        for value, in sess.query(PTR.value) \
+                .filter(PTR.value.in_(list(ptrs.keys()))):
+            del ptrs[value]
+
+    sess.bulk_save_objects(list(ptrs.values()))
+    sess.commit()
 
     sess.close()
 
-def arp_resolve(interface,target,verbose=0,retry=0,timeout=1):
-    '''Attempt to make an ARP request for the target. Returns
-    the MAC address for the target if successful, None otherwise.
+def arp_resolve_many(interface,targets,verbose=0,retry=0,timeout=1):
+    '''Make ARP requests for each of the targets with a single call
+    to `sr`, allowing all requests to share one timeout. Returns a
+    dictionary mapping each responding target to its MAC address.
     '''
 
+    if not targets: return {}
+
     results, unanswered = sr(
         ARP(
             op=1,
-            pdst=target,
+            pdst=list(targets),
         ),
         iface=interface,
         retry=retry,
@@ -63,27 +95,31 @@ def arp_resolve(interface,target,verbose=0,retry=0,timeout=1):
         timeout=timeout
     )
 
-    if results:
-        return results[0][1].hwsrc
-    else:
-        return None
+    return {received.psrc:received.hwsrc for sent,received in results}
 
 def arp_resolve_ips(interface,db_file,verbose=0,retry=0,timeout=1):
 
-    sess = create_db(db_file)
+    sess = create_db(db_file,wal=True)
     to_resolve = sess.query(IP) \
                     .filter(IP.arp_resolve_attempted != True) \
                     .all()
 
+    hwaddrs = arp_resolve_many(interface,[ip.value for ip in to_resolve],
+            verbose,retry,timeout)
+
+    mappings = []
     for ip in to_resolve:
 
-        hwaddr = arp_resolve(interface,ip.value,verbose,retry,timeout)
+        mapping = {'id':ip.id,'arp_resolve_attempted':True}
 
+        hwaddr = hwaddrs.get(ip.value)
         if hwaddr:
-            ip.mac_address = hwaddr
+            mapping['mac_address'] = hwaddr
+
+        mappings.append(mapping)
 
-        ip.arp_resolve_attempted = True
-        sess.commit()
+    sess.bulk_update_mappings(IP,mappings)
+    sess.commit()
 
     sess.close()
 
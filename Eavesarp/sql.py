@@ -2,10 +2,11 @@
 
 from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey,
         func, text, ForeignKeyConstraint, UniqueConstraint,
-        create_engine, asc, desc, Boolean)
+        create_engine, asc, desc, Boolean, event, bindparam)
 from sqlalchemy.orm import (relationship, backref, sessionmaker,
-        close_all_sessions)
+        close_all_sessions, joinedload)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext import baked
 from pathlib import Path
 from os import remove
 
@@ -65,6 +66,9 @@ class Transaction(Base):
     '''
 
     __tablename__ = 'transaction'
+    __table_args__ = (
+        UniqueConstraint('sender_ip_id','target_ip_id'),
+    )
     id = Column(Integer, primary_key=True)
     sender_ip_id = Column(Integer,nullable=False)
     target_ip_id = Column(Integer,nullable=False)
@@ -232,20 +236,39 @@ class Transaction(Base):
 
     bfh = build_from_handle
 
-def create_db(dbfile,overwrite=False):
+def create_db(dbfile,overwrite=False,wal=False):
     '''Initialize the database file and return a session
     object.
+
+    Set `wal` for databases written by this tool. The journal mode
+    is stored in the database file itself, so it should not be set
+    on input databases.
     '''
 
     engine = create_engine(f'sqlite:///{dbfile}')
+
+    if wal:
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            '''Use the write-ahead log and relax fsync behavior so that
+            batched commits from the sniffer are cheap.
+            '''
+
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+
     Session = sessionmaker()
     Session.configure(bind=engine)
 
-    pth = Path(dbfile)
-
-    # Remove the file if specified
-    if pth.exists() and overwrite:
-        remove(pth)
+    # Remove the file if specified, along with any write-ahead log
+    # files that would otherwise be replayed into the new database
+    if overwrite:
+        for suffix in ['','-wal','-shm']:
+            pth = Path(f'{dbfile}{suffix}')
+            if pth.exists(): remove(pth)
 
     # Don't clobber pre-existing database files
     if not Path(dbfile).exists() or overwrite:
@@ -253,23 +276,88 @@ def create_db(dbfile,overwrite=False):
 
     return Session()
 
+def close_db(db_session):
+    '''Refresh query planner statistics, checkpoint the write-ahead
+    log into the database file, and close the session, leaving a
+    self-contained database file.
+    '''
+
+    db_session.execute('ANALYZE')
+    db_session.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db_session.close()
+
 def get_transactions(db_session,order_by=desc):
+    '''Return all transactions ordered by count. Sender and target
+    IPs are joined in the same query and their PTR records are
+    loaded in one additional query, avoiding a lazy load for each
+    row of output.
+    '''
 
     # Getting all transaction objects
     return db_session.query(Transaction) \
+            .options(
+                joinedload(Transaction.sender).selectinload(IP.ptr),
+                joinedload(Transaction.target).selectinload(IP.ptr)) \
             .order_by(desc(Transaction.count)) \
             .all()
 
+# ============================
+# BAKED QUERIES FOR HOT LOOKUPS
+# ============================
+
+'''
+Baked queries cache the compiled SQL of a query, avoiding the cost
+of constructing and compiling the same lookup for every packet.
+'''
+
+bakery = baked.bakery()
+
+ip_by_value = bakery(lambda session: session.query(IP))
+ip_by_value += lambda q: q.filter(IP.value==bindparam('value'))
+
+transaction_by_pair = bakery(lambda session: session.query(Transaction))
+transaction_by_pair += lambda q: q.filter(
+    Transaction.sender_ip_id==bindparam('sender_ip_id'),
+    Transaction.target_ip_id==bindparam('target_ip_id'))
+
+def get_ip(value,db_session):
+    '''Get an IP object by value, returning `None` when it does not
+    exist.
+    '''
+
+    return ip_by_value(db_session) \
+            .params(value=value) \
+            .one_or_none()
+
+def get_transaction(sender_ip_id,target_ip_id,db_session):
+    '''Get the Transaction for a sender/target pair, returning `None`
+    when it does not exist.
+    '''
+
+    return transaction_by_pair(db_session) \
+            .params(sender_ip_id=sender_ip_id,target_ip_id=target_ip_id) \
+            .one_or_none()
+
 def get_or_create_ip(value, db_session, ptr=None, mac_address=None,
-        arp_resolve_attempted=False, reverse_dns_attempted=False):
+        arp_resolve_attempted=False, reverse_dns_attempted=False,
+        ip_cache=None):
     '''Get or create an IP object from the SQLite database. Also
     handles:
 
     - Reverse Name Resolution
     - ARP resolution
+
+    Changes are flushed, not committed. Callers are responsible for
+    committing the session.
+
+    `ip_cache` is an optional dictionary mapping IP values to IP
+    objects. It is checked prior to querying the database and is
+    populated with the returned object.
     '''
 
-    ip = db_session.query(IP).filter(IP.value==value).first()
+    ip = ip_cache.get(value) if ip_cache is not None else None
+    if not ip:
+        ip = get_ip(value,db_session)
 
     if not ip:
 
@@ -282,25 +370,14 @@ def get_or_create_ip(value, db_session, ptr=None, mac_address=None,
             ip.reverse_dns_attempted = True
 
         db_session.add(ip)
-        db_session.commit()
+        db_session.flush()
 
     elif ip and mac_address and ip.mac_address != mac_address:
 
         ip.mac_address = mac_address
         ip.arp_resolve_attempted = True
-        db_session.commit()
-
-    return ip
-
-def get_or_create_ptr(value,ip_id,db_session,forward_ip=None):
+        db_session.flush()
 
-    ptr = db_session.query(PTR).filter(PTR.value==value).first()
+    if ip_cache is not None: ip_cache[value] = ip
 
-    if not ptr:
-
-        ptr = PTR(value=value,ip_id=ip_id,forward_ip=forward_ip)
-
-        db_session.add(ptr)
-        db_session.commit()
-
-    return ptr
+    return ip
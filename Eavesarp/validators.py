@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from re import match,compile
-from scapy.all import ARP
+from scapy.layers.l2 import ARP
 
 # Regexp to validate ipv4 structure
 ipv4_re = compile('^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$')
@@ -20,10 +20,16 @@ def validate_packet(packet,unpack=True):
     the returned object will be ARP instead of Boolean.
     '''
 
-    if ARP in packet:
-        arp = packet.getlayer('ARP')
-        if arp.op == 1:
-            if unpack: return arp
-            else: return True
+    arp = packet.getlayer(ARP)
+    if arp is None: return False
+
+    try:
+        op = arp.fields['op']
+    except KeyError:
+        op = arp.op
+
+    if op == 1:
+        if unpack: return arp
+        else: return True
 
     return False